@@ -0,0 +1,230 @@
+import os
+import time
+import math
+import asyncio
+from dataclasses import dataclass, field
+from typing import Dict, Optional
+
+from fastapi import HTTPException, Form
+from starlette import status
+
+
+@dataclass
+class ChannelLimits:
+    max_concurrent: int
+    max_queued: int
+    per_user_concurrent: int
+    rate_per_second: float
+    burst: float
+    queue_timeout: float = 10.0
+
+
+def _limits_from_env(channel: str, default: ChannelLimits) -> ChannelLimits:
+    prefix = f"ADMISSION_{channel.upper()}_"
+    return ChannelLimits(
+        max_concurrent=int(os.getenv(prefix + "CONCURRENCY", default.max_concurrent)),
+        max_queued=int(os.getenv(prefix + "QUEUE", default.max_queued)),
+        per_user_concurrent=int(os.getenv(prefix + "PER_USER", default.per_user_concurrent)),
+        rate_per_second=float(os.getenv(prefix + "RATE", default.rate_per_second)),
+        burst=float(os.getenv(prefix + "BURST", default.burst)),
+        queue_timeout=float(os.getenv(prefix + "QUEUE_TIMEOUT", default.queue_timeout)),
+    )
+
+
+# Email buckets are charged per recipient, the chat channels per message.
+DEFAULT_LIMITS = {
+    "email": ChannelLimits(max_concurrent=2, max_queued=8, per_user_concurrent=1, rate_per_second=20, burst=500),
+    "discord": ChannelLimits(max_concurrent=4, max_queued=16, per_user_concurrent=2, rate_per_second=1, burst=5),
+    "slack": ChannelLimits(max_concurrent=4, max_queued=16, per_user_concurrent=2, rate_per_second=1, burst=5),
+}
+
+
+def too_many_requests(detail: str, retry_after: float) -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+        detail=detail,
+        headers={"Retry-After": str(max(1, math.ceil(retry_after)))},
+    )
+
+
+@dataclass
+class TokenBucket:
+    rate: float
+    capacity: float
+    tokens: float = field(default=0.0)
+    updated: float = field(default_factory=time.monotonic)
+
+    def __post_init__(self):
+        self.tokens = self.capacity
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, cost: float) -> float:
+        """Take ``cost`` tokens, returning 0 on success or the seconds to wait otherwise."""
+        now = time.monotonic()
+        self._refill(now)
+        if self.tokens >= cost:
+            self.tokens -= cost
+            return 0.0
+        return (cost - self.tokens) / self.rate
+
+    def refund(self, cost: float):
+        self._refill(time.monotonic())
+        self.tokens = min(self.capacity, self.tokens + cost)
+
+
+class Lease:
+    def __init__(self, controller: "AdmissionController", channel: str, user: str):
+        self.controller = controller
+        self.channel = channel
+        self.user = user
+        self.released = False
+        self.detached = False
+
+    def detach(self) -> "Lease":
+        """Keep the slot after the request ends; the new owner must call ``release``."""
+        self.detached = True
+        return self
+
+    def charge(self, cost: float):
+        self.controller._charge(self.channel, self.user, cost)
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.controller._release(self.channel, self.user)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if not self.detached:
+            self.release()
+
+
+class _ChannelState:
+    def __init__(self, limits: ChannelLimits):
+        self.limits = limits
+        self.semaphore: Optional[asyncio.Semaphore] = None
+        self.in_flight = 0
+        self.queued = 0
+        self.rejected = 0
+        self.per_user: Dict[str, int] = {}
+        self.buckets: Dict[str, TokenBucket] = {}
+
+
+class AdmissionController:
+    """Per-channel concurrency caps and bounded wait queues with per-user quotas.
+
+    State is local to the worker process, so the effective limits under gunicorn
+    are the configured ones multiplied by the number of workers.
+    """
+
+    def __init__(self, limits: Dict[str, ChannelLimits]):
+        self.channels = {name: _ChannelState(channel_limits) for name, channel_limits in limits.items()}
+        self.closed = False
+
+    def close(self):
+        """Reject all new work, e.g. while the worker drains before shutting down."""
+        self.closed = True
+
+    async def acquire(self, channel: str, user: str, cost: Optional[float] = None) -> Lease:
+        if self.closed:
+            raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                                detail="Server is shutting down", headers={"Retry-After": "5"})
+
+        state = self.channels[channel]
+        limits = state.limits
+        if state.semaphore is None:
+            # Created lazily so the semaphore binds to the running event loop.
+            state.semaphore = asyncio.Semaphore(limits.max_concurrent)
+
+        if state.per_user.get(user, 0) >= limits.per_user_concurrent:
+            state.rejected += 1
+            raise too_many_requests(f"Too many {channel} requests in progress for {user}", 1)
+
+        if state.in_flight >= limits.max_concurrent and state.queued >= limits.max_queued:
+            state.rejected += 1
+            raise too_many_requests(f"The {channel} queue is full", limits.queue_timeout)
+
+        if cost is not None:
+            self._charge(channel, user, cost)
+
+        state.per_user[user] = state.per_user.get(user, 0) + 1
+        state.queued += 1
+        try:
+            await asyncio.wait_for(state.semaphore.acquire(), timeout=limits.queue_timeout)
+        except BaseException as e:
+            # Requests that never got a slot, timed out or cancelled, should not count against the user.
+            self._drop_user(state, user)
+            if cost is not None:
+                state.buckets[user].refund(cost)
+            if not isinstance(e, asyncio.TimeoutError):
+                raise
+            state.rejected += 1
+            raise too_many_requests(f"Timed out waiting in the {channel} queue", limits.queue_timeout)
+        finally:
+            state.queued -= 1
+
+        state.in_flight += 1
+        return Lease(self, channel, user)
+
+    def _charge(self, channel: str, user: str, cost: float):
+        state = self.channels[channel]
+        limits = state.limits
+        if cost > limits.burst:
+            state.rejected += 1
+            raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                                detail=f"Request exceeds the {channel} quota of {int(limits.burst)}")
+
+        bucket = state.buckets.get(user)
+        if bucket is None:
+            bucket = state.buckets[user] = TokenBucket(rate=limits.rate_per_second, capacity=limits.burst)
+        retry_after = bucket.take(cost)
+        if retry_after:
+            state.rejected += 1
+            raise too_many_requests(f"{channel} quota exhausted for {user}", retry_after)
+
+    def _drop_user(self, state: _ChannelState, user: str):
+        state.per_user[user] -= 1
+        if not state.per_user[user]:
+            del state.per_user[user]
+
+    def _release(self, channel: str, user: str):
+        state = self.channels[channel]
+        state.in_flight -= 1
+        self._drop_user(state, user)
+        state.semaphore.release()
+
+    def occupancy(self) -> Dict[str, Dict]:
+        return {
+            name: {
+                "in_flight": state.in_flight,
+                "queued": state.queued,
+                "max_concurrent": state.limits.max_concurrent,
+                "max_queued": state.limits.max_queued,
+                "rejected": state.rejected,
+                "active_users": dict(state.per_user),
+            }
+            for name, state in self.channels.items()
+        }
+
+
+controller = AdmissionController({
+    channel: _limits_from_env(channel, limits) for channel, limits in DEFAULT_LIMITS.items()
+})
+
+
+def admit(channel: str, charge: bool = True):
+    """Build a dependency that holds a ``channel`` slot for the whole request.
+
+    The slot is released once the response and any background tasks finish.
+    With ``charge=False`` the handler charges the quota itself via ``Lease.charge``.
+    """
+    async def dependency(user: str = Form(...)):
+        async with await controller.acquire(channel, user, cost=1 if charge else None) as lease:
+            yield lease
+
+    return dependency
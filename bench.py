@@ -0,0 +1,79 @@
+"""Microbenchmark of per-request overhead for the request/response layer.
+
+Compares multipart form parsing against JSON bodies for the same text-only
+payload, and the stdlib JSON encoder against orjson for response envelopes.
+Nothing is sent: the routes only parse the request and build the response.
+
+    python bench.py [iterations]
+"""
+import sys
+import json
+import time
+import asyncio
+
+import httpx
+import orjson
+from fastapi import FastAPI, Depends
+from fastapi.responses import JSONResponse, ORJSONResponse
+
+import schemas
+
+
+app = FastAPI()
+
+
+@app.post("/form", response_class=ORJSONResponse)
+async def form_route(form: schemas.MessageForm = Depends(schemas.MessageForm.as_form)):
+    return schemas.MessageResponse(message=form.message).dict(exclude_none=True)
+
+
+@app.post("/json", response_class=ORJSONResponse)
+async def json_route(request: schemas.ChatMessageRequest):
+    return schemas.MessageResponse(message=request.message).dict(exclude_none=True)
+
+
+@app.post("/json/stdlib", response_class=JSONResponse)
+async def json_stdlib_route(request: schemas.ChatMessageRequest):
+    return schemas.MessageResponse(message=request.message).dict(exclude_none=True)
+
+
+async def time_requests(client: httpx.AsyncClient, iterations: int, **kwargs) -> float:
+    start = time.perf_counter()
+    for _ in range(iterations):
+        response = await client.post(**kwargs)
+        response.raise_for_status()
+    return (time.perf_counter() - start) / iterations * 1e6
+
+
+def time_encoder(encode, payload, iterations: int) -> float:
+    start = time.perf_counter()
+    for _ in range(iterations):
+        encode(payload)
+    return (time.perf_counter() - start) / iterations * 1e6
+
+
+async def main(iterations: int):
+    payload = {"user": "bench", "message": "Hello from the benchmark " * 8}
+    async with httpx.AsyncClient(app=app, base_url="http://bench") as client:
+        results = {
+            "multipart form": await time_requests(client, iterations, url="/form", data=payload,
+                                                  files={"unused": ("a.txt", b"")}),
+            "urlencoded form": await time_requests(client, iterations, url="/form", data=payload),
+            "json body, orjson": await time_requests(client, iterations, url="/json", json=payload),
+            "json body, stdlib json": await time_requests(client, iterations, url="/json/stdlib", json=payload),
+        }
+
+    error = schemas.ErrorResponse(error=schemas.ErrorDetail(
+        code="validation_error", message="Invalid request",
+        details=[{"loc": ["body", "user"], "msg": "field required", "type": "value_error.missing"}] * 4,
+    )).dict(exclude_none=True)
+    results["error envelope, stdlib json"] = time_encoder(lambda content: json.dumps(content).encode(), error,
+                                                          iterations * 10)
+    results["error envelope, orjson"] = time_encoder(orjson.dumps, error, iterations * 10)
+
+    for name, micros in results.items():
+        print(f"{name:<28} {micros:10.1f} us/op")
+
+
+if __name__ == "__main__":
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 2000))
@@ -0,0 +1,155 @@
+import os
+import time
+import json
+import sqlite3
+import asyncio
+import hashlib
+import logging
+import threading
+from typing import Awaitable, Callable, Dict, Iterable, Optional
+
+from fastapi.responses import ORJSONResponse
+from starlette import status
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import Response
+
+import schemas
+
+
+logger = logging.getLogger(__name__)
+
+# Only complete successes are replayed; a 207 partial delivery may be retried for the missed recipients.
+CACHEABLE_STATUS = (status.HTTP_200_OK, status.HTTP_201_CREATED, status.HTTP_202_ACCEPTED)
+
+
+def request_key(user: str, channel: str, recipients: Iterable[str], *body: str) -> str:
+    recipients_digest = hashlib.sha256("\n".join(sorted(map(str, recipients))).encode()).hexdigest()
+    return hashlib.sha256(json.dumps([user, channel, recipients_digest, *body]).encode()).hexdigest()
+
+
+class DedupCache:
+    """Short-window cache of send results, shared between worker processes through SQLite.
+
+    The first request for a key claims it with a pending row and performs the send;
+    identical requests within ``ttl`` seconds replay the stored response, or wait
+    for it while the first one is still in flight. Failed and partial sends are not cached.
+    """
+
+    def __init__(self, path: str, ttl: float = 60, pending_timeout: float = 300, wait_timeout: float = 30):
+        self.ttl = ttl
+        self.pending_timeout = pending_timeout
+        self.wait_timeout = wait_timeout
+        # Expired rows are also dropped when their key is claimed again, so a periodic sweep is enough.
+        self.eviction_interval = ttl
+        self.next_eviction = 0.0
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, timeout=5, isolation_level=None, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS sends ("
+            "key TEXT PRIMARY KEY, expires_at REAL NOT NULL, status_code INTEGER, body BLOB)"
+        )
+        self.connection.execute("CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+        self.connection.executemany(
+            "INSERT OR IGNORE INTO counters (name, value) VALUES (?, 0)",
+            [("hits",), ("misses",), ("evictions",)],
+        )
+
+    def _execute(self, sql: str, parameters=()) -> int:
+        with self.lock:
+            return self.connection.execute(sql, parameters).rowcount
+
+    def _query(self, sql: str, parameters=()) -> list:
+        # Rows are fetched under the lock too, since the connection is shared between threads.
+        with self.lock:
+            return self.connection.execute(sql, parameters).fetchall()
+
+    def _count(self, name: str, amount: int = 1):
+        if amount:
+            self._execute("UPDATE counters SET value = value + ? WHERE name = ?", (amount, name))
+
+    def _evict_expired(self):
+        self._count("evictions", self._execute("DELETE FROM sends WHERE expires_at < ?", (time.time(),)))
+
+    def _claim(self, key: str) -> bool:
+        now = time.time()
+        self._count("evictions", self._execute("DELETE FROM sends WHERE key = ? AND expires_at < ?", (key, now)))
+        return self._execute(
+            "INSERT OR IGNORE INTO sends (key, expires_at) VALUES (?, ?)",
+            (key, now + self.pending_timeout),
+        ) == 1
+
+    def _lookup(self, key: str):
+        rows = self._query(
+            "SELECT status_code, body FROM sends WHERE key = ? AND expires_at >= ?", (key, time.time())
+        )
+        return rows[0] if rows else None
+
+    def _finish(self, key: str, response: Optional[Response]):
+        if response is not None and response.status_code in CACHEABLE_STATUS:
+            self._execute(
+                "UPDATE sends SET status_code = ?, body = ?, expires_at = ? WHERE key = ?",
+                (response.status_code, response.body, time.time() + self.ttl, key),
+            )
+        else:
+            self._execute("DELETE FROM sends WHERE key = ?", (key,))
+
+    async def _wait_for_result(self, key: str):
+        deadline = time.monotonic() + self.wait_timeout
+        while time.monotonic() < deadline:
+            row = await run_in_threadpool(self._lookup, key)
+            if row is None or row[0] is not None:
+                return row
+            await asyncio.sleep(0.1)
+        raise asyncio.TimeoutError
+
+    async def run(self, key: str, send: Callable[[], Awaitable[Response]]) -> Response:
+        # SQLite calls run in the threadpool so lock contention between workers never blocks the event loop.
+        try:
+            if time.monotonic() >= self.next_eviction:
+                self.next_eviction = time.monotonic() + self.eviction_interval
+                await run_in_threadpool(self._evict_expired)
+
+            while not await run_in_threadpool(self._claim, key):
+                try:
+                    row = await self._wait_for_result(key)
+                except asyncio.TimeoutError:
+                    error = schemas.ErrorResponse(error=schemas.ErrorDetail(
+                        code="duplicate_in_progress", message="An identical request is still being sent."))
+                    return ORJSONResponse(status_code=status.HTTP_409_CONFLICT, content=error.dict(exclude_none=True))
+                if row is not None:
+                    await run_in_threadpool(self._count, "hits")
+                    return Response(status_code=row[0], content=row[1], media_type="application/json",
+                                    headers={"X-Dedup": "hit"})
+                # The original send failed and released its claim, so try to claim it again.
+
+            await run_in_threadpool(self._count, "misses")
+
+        except sqlite3.Error:
+            # The cache only suppresses duplicates; if it is unavailable, send without it.
+            logger.exception("Dedup cache unavailable, sending without deduplication")
+            return await send()
+
+        response = None
+        try:
+            response = await send()
+        finally:
+            try:
+                await run_in_threadpool(self._finish, key, response)
+            except sqlite3.Error:
+                logger.exception("Could not record the result of a deduplicated send")
+        return response
+
+    def _stats(self) -> Dict[str, int]:
+        counters = dict(self._query("SELECT name, value FROM counters"))
+        counters["entries"] = self._query("SELECT COUNT(*) FROM sends")[0][0]
+        return counters
+
+    async def stats(self) -> Dict[str, int]:
+        return await run_in_threadpool(self._stats)
+
+
+cache = DedupCache(
+    os.getenv("DEDUP_DB", "./dedup.db"),
+    ttl=float(os.getenv("DEDUP_TTL", 60)),
+)
@@ -0,0 +1,254 @@
+import os
+import time
+import asyncio
+import logging
+import mimetypes
+from collections import defaultdict
+from dataclasses import dataclass, field
+from email.message import EmailMessage
+from email.utils import formatdate, make_msgid
+from typing import Dict, List, Optional, Tuple
+
+import aiosmtplib
+import dns.asyncresolver
+import dns.exception
+import dns.resolver
+
+
+logger = logging.getLogger(__name__)
+
+DELIVERY_MODES = ("single", "domain", "mx")
+
+
+@dataclass
+class DeliveryProfile:
+    concurrency: int = 2
+    batch_size: int = 50
+    delay: float = 0.0
+
+
+DEFAULT_PROFILE = DeliveryProfile()
+
+# Large providers throttle bursts from a single sender, so keep batches small and spaced out.
+DOMAIN_PROFILES = {
+    "gmail.com": DeliveryProfile(concurrency=2, batch_size=50, delay=1.0),
+    "googlemail.com": DeliveryProfile(concurrency=2, batch_size=50, delay=1.0),
+    "outlook.com": DeliveryProfile(concurrency=1, batch_size=20, delay=2.0),
+    "hotmail.com": DeliveryProfile(concurrency=1, batch_size=20, delay=2.0),
+    "yahoo.com": DeliveryProfile(concurrency=1, batch_size=20, delay=2.0),
+}
+
+
+@dataclass
+class Relay:
+    host: str
+    port: int = 25
+    username: Optional[str] = None
+    password: Optional[str] = None
+    use_tls: bool = False
+    start_tls: bool = False
+    # Upgrade with STARTTLS when the server advertises it, without requiring a valid certificate.
+    opportunistic_tls: bool = False
+    max_sessions: int = 4
+
+    @property
+    def address(self) -> str:
+        return f"{self.host}:{self.port}"
+
+
+@dataclass
+class DomainReport:
+    relay: Optional[str] = None
+    sent: int = 0
+    failed: List[str] = field(default_factory=list)
+    errors: List[str] = field(default_factory=list)
+
+
+def group_by_domain(recipients: List[str]) -> Dict[str, List[str]]:
+    groups = defaultdict(list)
+    for recipient in recipients:
+        domain = recipient.rsplit("@", 1)[-1].strip().lower()
+        groups[domain].append(recipient)
+    return dict(groups)
+
+
+def parse_relays(spec: str) -> Dict[str, Relay]:
+    """Parse ``domain=host:port`` pairs separated by ``;``. ``*`` matches every domain."""
+    relays = {}
+    for entry in filter(None, (part.strip() for part in spec.split(";"))):
+        domain, _, address = entry.partition("=")
+        host, _, port = address.strip().partition(":")
+        relays[domain.strip().lower()] = Relay(host=host, port=int(port or 25))
+    return relays
+
+
+class MXCache:
+    def __init__(self, ttl: float = 3600, negative_ttl: float = 300):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.entries: Dict[str, Tuple[float, List[str]]] = {}
+        self.hits = 0
+        self.misses = 0
+
+    async def lookup(self, domain: str) -> List[str]:
+        entry = self.entries.get(domain)
+        if entry and entry[0] > time.monotonic():
+            self.hits += 1
+            return entry[1]
+
+        self.misses += 1
+        ttl = self.ttl
+        try:
+            answer = await dns.asyncresolver.resolve(domain, "MX")
+            hosts = [str(record.exchange).rstrip(".") for record in sorted(answer, key=lambda r: r.preference)]
+            ttl = min(ttl, answer.rrset.ttl)
+        except dns.resolver.NoAnswer:
+            # RFC 5321 implicit MX: fall back to the domain's own address record.
+            hosts = [domain]
+        except (dns.exception.DNSException, ValueError):
+            # NXDOMAIN, timeouts, and names that are not valid DNS names (e.g. ``foo..com``).
+            hosts = []
+            ttl = self.negative_ttl
+
+        self.entries[domain] = (time.monotonic() + ttl, hosts)
+        return hosts
+
+
+class RelayRouter:
+    """Pick the relays for a destination domain.
+
+    ``overrides`` take precedence (use them to point at local stand-in relays);
+    in ``mx`` mode the rest are resolved through the MX cache and in ``domain``
+    mode everything goes through the ``smarthost``. Open sessions are capped per
+    relay across all sends, so one send cannot flood a shared smarthost.
+    """
+
+    def __init__(self, smarthost: Optional[Relay] = None, overrides: Optional[Dict[str, Relay]] = None,
+                 mx_cache: Optional[MXCache] = None):
+        self.smarthost = smarthost
+        self.overrides = overrides or {}
+        self.mx_cache = mx_cache or MXCache()
+        self.sessions: Dict[str, asyncio.Semaphore] = {}
+
+    def session_slots(self, relay: Relay) -> asyncio.Semaphore:
+        slots = self.sessions.get(relay.address)
+        if slots is None:
+            # Created lazily so the semaphore binds to the running event loop.
+            slots = self.sessions[relay.address] = asyncio.Semaphore(relay.max_sessions)
+        return slots
+
+    async def relays_for(self, domain: str, mode: str) -> List[Relay]:
+        override = self.overrides.get(domain) or self.overrides.get("*")
+        if override:
+            return [override]
+        if mode == "mx":
+            return [Relay(host=host, opportunistic_tls=True) for host in await self.mx_cache.lookup(domain)]
+        return [self.smarthost] if self.smarthost else []
+
+
+def build_message(sender: str, subject: str, body: str,
+                  attachments: Optional[List[Tuple[str, bytes]]] = None) -> EmailMessage:
+    message = EmailMessage()
+    message["From"] = sender
+    message["To"] = "undisclosed-recipients:;"
+    message["Subject"] = subject
+    message["Date"] = formatdate(localtime=True)
+    message["Message-ID"] = make_msgid(domain=sender.rsplit("@", 1)[-1])
+    message.set_content(body)
+    for filename, content in attachments or []:
+        content_type = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+        maintype, subtype = content_type.split("/", 1)
+        message.add_attachment(content, maintype=maintype, subtype=subtype, filename=filename)
+    return message
+
+
+async def _deliver(message: EmailMessage, sender: str, batch: List[str], relay: Relay):
+    if not relay.opportunistic_tls:
+        await aiosmtplib.send(
+            message, sender=sender, recipients=batch,
+            hostname=relay.host, port=relay.port,
+            username=relay.username, password=relay.password,
+            use_tls=relay.use_tls, start_tls=relay.start_tls,
+        )
+        return
+
+    smtp = aiosmtplib.SMTP(hostname=relay.host, port=relay.port, start_tls=False, validate_certs=False)
+    async with smtp:
+        await smtp.ehlo()
+        if smtp.supports_extension("starttls"):
+            await smtp.starttls()
+        await smtp.send_message(message, sender=sender, recipients=batch)
+
+
+async def _send_batch(message: EmailMessage, sender: str, batch: List[str], relays: List[Relay],
+                      router: RelayRouter, report: DomainReport):
+    for relay in relays:
+        try:
+            async with router.session_slots(relay):
+                await _deliver(message, sender, batch, relay)
+        except (aiosmtplib.SMTPException, OSError) as e:
+            logger.warning("Delivery through %s failed: %s", relay.address, e)
+            report.errors.append(f"{relay.host}: {e}")
+            continue
+        report.relay = relay.address
+        report.sent += len(batch)
+        return
+    report.failed.extend(batch)
+
+
+async def _send_domain(message: EmailMessage, sender: str, domain: str, recipients: List[str],
+                       router: RelayRouter, mode: str, domain_slots: asyncio.Semaphore) -> DomainReport:
+    report = DomainReport()
+    relays = await router.relays_for(domain, mode)
+    if not relays:
+        report.failed.extend(recipients)
+        report.errors.append(f"No relay available for {domain}")
+        return report
+
+    profile = DOMAIN_PROFILES.get(domain, DEFAULT_PROFILE)
+    batches = [recipients[i:i + profile.batch_size] for i in range(0, len(recipients), profile.batch_size)]
+    batch_slots = asyncio.Semaphore(profile.concurrency)
+
+    async def send(index: int, batch: List[str]):
+        async with batch_slots:
+            if index >= profile.concurrency and profile.delay:
+                await asyncio.sleep(profile.delay)
+            await _send_batch(message, sender, batch, relays, router, report)
+
+    async with domain_slots:
+        await asyncio.gather(*(send(index, batch) for index, batch in enumerate(batches)))
+    return report
+
+
+async def send_by_domain(message: EmailMessage, recipients: List[str], router: RelayRouter,
+                         mode: str = "domain", max_domains: int = 8) -> Dict[str, DomainReport]:
+    """Deliver ``message`` with one SMTP transaction per recipient batch, grouped by domain."""
+    sender = message["From"]
+    domain_slots = asyncio.Semaphore(max_domains)
+    groups = group_by_domain(recipients)
+    reports = await asyncio.gather(*(
+        _send_domain(message, sender, domain, group, router, mode, domain_slots)
+        for domain, group in groups.items()
+    ), return_exceptions=True)
+
+    # One domain failing unexpectedly must not hide what was already delivered to the others.
+    results = {}
+    for (domain, group), report in zip(groups.items(), reports):
+        if isinstance(report, Exception):
+            logger.warning("Delivery to %s failed: %r", domain, report)
+            report = DomainReport(failed=list(group), errors=[f"{type(report).__name__}: {report}"])
+        results[domain] = report
+    return results
+
+
+router = RelayRouter(
+    smarthost=Relay(
+        host="smtp.gmail.com",
+        port=587,
+        username=os.getenv("EMAIL_USERNAME"),
+        password=os.getenv("EMAIL_PASSWORD"),
+        start_tls=True,
+        max_sessions=int(os.getenv("EMAIL_RELAY_SESSIONS", 2)),
+    ),
+    overrides=parse_relays(os.getenv("MAIL_RELAYS", "")),
+)
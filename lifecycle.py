@@ -0,0 +1,249 @@
+import os
+import json
+import time
+import uuid
+import asyncio
+import logging
+import datetime
+from typing import Awaitable, Callable, Dict, List, Optional, Set
+
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from starlette.concurrency import run_in_threadpool
+
+import models
+import admission
+from database import SessionLocal
+
+
+logger = logging.getLogger(__name__)
+
+Handler = Callable[[dict], Awaitable[None]]
+
+CLAIM_JOB_ID = "outbox-claim"
+
+
+class _Job:
+    def __init__(self, kind: str, payload: dict, lease: Optional[admission.Lease]):
+        self.kind = kind
+        self.payload = payload
+        self.lease = lease
+
+
+class LifecycleManager:
+    """Own the background sends of a worker so they survive its shutdown.
+
+    Work is described by a ``kind`` with a registered handler and a JSON-serialisable
+    ``payload``, either run now (``submit``) or later (``schedule``).
+
+    Scheduled jobs are written to the outbox table as soon as they are scheduled
+    and removed when they run, so a killed worker does not lose them. Each worker
+    holds its rows under a lease it renews every ``claim_interval`` seconds, and
+    adopts rows that are unowned or whose lease has expired. On shutdown new work
+    is refused, the worker's scheduled rows are released to its peers at once,
+    running sends get ``drain_timeout`` seconds to finish, and whatever is left is
+    written to the outbox too.
+    """
+
+    def __init__(self, drain_timeout: float = 20, timezone: str = "Asia/Kolkata",
+                 claim_interval: float = 5, claim_ttl: float = 30):
+        self.drain_timeout = drain_timeout
+        self.timezone = timezone
+        self.claim_interval = claim_interval
+        self.claim_ttl = claim_ttl
+        self.handlers: Dict[str, Handler] = {}
+        self.close_callbacks: List[Callable[[], Awaitable[None]]] = []
+        self.tasks: Dict[asyncio.Task, _Job] = {}
+        self.scheduler: Optional[AsyncIOScheduler] = None
+        self.token = uuid.uuid4().hex
+        self.outbox_ids: Set[int] = set()
+        self.claim_lock: Optional[asyncio.Lock] = None
+        self.last_drain: Optional[dict] = None
+
+    def register(self, kind: str, handler: Handler):
+        self.handlers[kind] = handler
+
+    def on_shutdown(self, callback: Callable[[], Awaitable[None]]):
+        self.close_callbacks.append(callback)
+
+    def submit(self, kind: str, payload: dict, lease: Optional[admission.Lease] = None) -> asyncio.Task:
+        """Run ``payload`` in the background; a detached ``lease`` is released when it finishes."""
+        job = _Job(kind, payload, lease.detach() if lease else None)
+        task = asyncio.create_task(self._run(job))
+        self.tasks[task] = job
+        task.add_done_callback(self._finished)
+        return task
+
+    def schedule(self, kind: str, payload: dict, trigger: str = "date", **trigger_args):
+        job = self.scheduler.add_job(self._run_scheduled, trigger, kwargs={"kind": kind, "payload": payload},
+                                     timezone=self.timezone, **trigger_args)
+        try:
+            outbox_id = self._persist_one(kind, payload, job.next_run_time)
+        except Exception:
+            job.remove()
+            raise
+        job.modify(kwargs={"kind": kind, "payload": payload, "outbox_id": outbox_id})
+        self.outbox_ids.add(outbox_id)
+
+    def _adopt(self, outbox_id: int, kind: str, payload: dict, run_at: datetime.datetime):
+        self.scheduler.add_job(self._run_scheduled, "date", run_date=run_at, timezone=self.timezone,
+                               kwargs={"kind": kind, "payload": payload, "outbox_id": outbox_id})
+        self.outbox_ids.add(outbox_id)
+
+    async def _run(self, job: _Job):
+        try:
+            await self.handlers[job.kind](job.payload)
+        except Exception:
+            logger.exception("Background %s send failed", job.kind)
+
+    async def _run_scheduled(self, kind: str, payload: dict, outbox_id: Optional[int] = None):
+        if outbox_id is not None:
+            self.outbox_ids.discard(outbox_id)
+            if not await run_in_threadpool(self._take_row, outbox_id):
+                # Another worker adopted the row after this one missed renewing its lease.
+                return
+        await self.submit(kind, payload)
+
+    def _finished(self, task: asyncio.Task):
+        job = self.tasks.pop(task, None)
+        if job and job.lease:
+            job.lease.release()
+
+    async def startup(self):
+        self.scheduler = AsyncIOScheduler(timezone=self.timezone)
+        self.scheduler.start()
+        self.claim_lock = asyncio.Lock()
+        await self.claim()
+        # Rows released by peers that stop (or die) while this worker runs are adopted here.
+        self.scheduler.add_job(self.claim, "interval", seconds=self.claim_interval, id=CLAIM_JOB_ID,
+                               max_instances=1, coalesce=True)
+
+    async def claim(self):
+        """Renew this worker's outbox lease and adopt unowned or expired rows."""
+        async with self.claim_lock:
+            claimed = await run_in_threadpool(self._claim_outbox)
+        for outbox_id, kind, payload, run_at in claimed:
+            if outbox_id in self.outbox_ids:
+                # Scheduled by this worker while the claim was running.
+                continue
+            if run_at and run_at > datetime.datetime.now(datetime.timezone.utc):
+                self._adopt(outbox_id, kind, payload, run_at)
+            elif await run_in_threadpool(self._take_row, outbox_id):
+                self.submit(kind, payload)
+
+    async def shutdown(self) -> dict:
+        started = time.monotonic()
+        admission.controller.close()
+
+        # Scheduled jobs are already in the outbox; hand them over before draining, so
+        # a kill at the end of the graceful timeout cannot lose them.
+        released = 0
+        if self.scheduler:
+            # A claim cut short by the scheduler shutdown could still take rows after the release.
+            self.scheduler.remove_job(CLAIM_JOB_ID)
+            async with self.claim_lock:
+                self.scheduler.shutdown(wait=False)
+                released = self._release_outbox()
+
+        pending_jobs = []
+        completed = len(self.tasks)
+        if self.tasks:
+            _, unfinished = await asyncio.wait(list(self.tasks), timeout=self.drain_timeout)
+            completed -= len(unfinished)
+            pending_jobs = [(self.tasks[task].kind, self.tasks[task].payload, None) for task in unfinished]
+            for task in unfinished:
+                task.cancel()
+
+        self._persist(pending_jobs)
+
+        for callback in self.close_callbacks:
+            try:
+                await callback()
+            except Exception:
+                logger.exception("Error while closing a client during shutdown")
+
+        self.last_drain = {
+            "drain_seconds": round(time.monotonic() - started, 3),
+            "completed": completed,
+            "persisted": len(pending_jobs) + released,
+        }
+        logger.warning("Worker drained in %(drain_seconds)ss: %(completed)s sends completed, "
+                       "%(persisted)s persisted to the outbox", self.last_drain)
+        return self.last_drain
+
+    def _persist(self, jobs: list):
+        if not jobs:
+            return
+        db = SessionLocal()
+        try:
+            db.add_all([
+                models.Outbox(kind=kind, payload=json.dumps(payload),
+                              run_at=run_at.isoformat() if run_at else None)
+                for kind, payload, run_at in jobs
+            ])
+            db.commit()
+        finally:
+            db.close()
+
+    def _persist_one(self, kind: str, payload: dict, run_at: Optional[datetime.datetime]) -> int:
+        db = SessionLocal()
+        try:
+            row = models.Outbox(kind=kind, payload=json.dumps(payload),
+                                run_at=run_at.isoformat() if run_at else None,
+                                claimed_by=self.token, claimed_until=time.time() + self.claim_ttl)
+            db.add(row)
+            db.commit()
+            return row.id
+        finally:
+            db.close()
+
+    def _claim_outbox(self) -> list:
+        now = time.time()
+        db = SessionLocal()
+        try:
+            outbox = db.query(models.Outbox)
+            outbox.filter(models.Outbox.claimed_by == self.token).update(
+                {models.Outbox.claimed_until: now + self.claim_ttl}, synchronize_session=False)
+            outbox.filter(models.Outbox.claimed_by.is_(None) | (models.Outbox.claimed_until < now)).update(
+                {models.Outbox.claimed_by: self.token, models.Outbox.claimed_until: now + self.claim_ttl},
+                synchronize_session=False)
+            db.commit()
+            rows = outbox.filter(models.Outbox.claimed_by == self.token).all()
+            return [(row.id, row.kind, json.loads(row.payload),
+                     datetime.datetime.fromisoformat(row.run_at) if row.run_at else None)
+                    for row in rows if row.id not in self.outbox_ids]
+        finally:
+            db.close()
+
+    def _take_row(self, outbox_id: int) -> bool:
+        """Delete a row this worker still owns, returning whether it did."""
+        db = SessionLocal()
+        try:
+            deleted = db.query(models.Outbox).filter(
+                models.Outbox.id == outbox_id, models.Outbox.claimed_by == self.token
+            ).delete(synchronize_session=False)
+            db.commit()
+            return bool(deleted)
+        finally:
+            db.close()
+
+    def _release_outbox(self) -> int:
+        db = SessionLocal()
+        try:
+            released = db.query(models.Outbox).filter(models.Outbox.claimed_by == self.token).update(
+                {models.Outbox.claimed_by: None, models.Outbox.claimed_until: None}, synchronize_session=False)
+            db.commit()
+            self.outbox_ids.clear()
+            return released
+        finally:
+            db.close()
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": len(self.tasks),
+            "scheduled": len(self.outbox_ids),
+            "accepting": not admission.controller.closed,
+            "last_drain": self.last_drain,
+        }
+
+
+manager = LifecycleManager(drain_timeout=float(os.getenv("SHUTDOWN_DRAIN_TIMEOUT", 20)))
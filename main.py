@@ -2,25 +2,30 @@ import os
 
 from fastapi import (
     FastAPI,
-    BackgroundTasks,
-    UploadFile, File, Form, Depends, HTTPException
+    UploadFile, File, Form, Depends
 )
 from dotenv import load_dotenv
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.encoders import jsonable_encoder
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import ORJSONResponse
 
-from typing import List
+from typing import Awaitable, Callable, List, Optional
 
 from sqlalchemy.orm import Session
 from starlette import status
-from starlette.responses import JSONResponse
+from starlette.exceptions import HTTPException as StarletteHTTPException
 import shutil
 from tempfile import NamedTemporaryFile
 from pathlib import Path
-from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from http import HTTPStatus
 import markdown
 import re
 import datetime
 import asyncio
+import dataclasses
+import base64
+import io
 
 
 from fastapi_mail import FastMail, MessageSchema, ConnectionConfig
@@ -35,11 +40,14 @@ from slack_sdk import WebClient
 from slack_sdk.errors import SlackApiError
 import logging
 
-import models, schemas, database
+# Loaded before the local modules so their env-driven settings (e.g. admission limits) see .env values.
+load_dotenv()
+
+import models, schemas, database, admission, delivery, dedup, lifecycle
 from database import engine
 
 
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse)
 
 
 app.add_middleware(
@@ -50,8 +58,6 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-load_dotenv()
-
 conf = ConnectionConfig(
     MAIL_USERNAME=os.getenv("EMAIL_USERNAME"),
     MAIL_PASSWORD=os.getenv("EMAIL_PASSWORD"),
@@ -66,296 +72,330 @@ conf = ConnectionConfig(
 
 models.Base.metadata.create_all(bind=engine)
 
+logger = logging.getLogger(__name__)
 
-@app.post("/login")
-async def user_login(username: str = Form(...), password: str = Form(...), db: Session = Depends(database.get_db)):
-    user = db.query(models.User).filter(models.User.username == username).first()
-    if not user:
-        return JSONResponse(status_code=status.HTTP_404_NOT_FOUND, content=f"user {username} does not exists.")
+DISCORD_CHANNEL_ID = 955391175823618072
+HTML_TAG = re.compile(r'<.*?>')
 
-    if password != user.password:
-        return JSONResponse(status_code=status.HTTP_400_BAD_REQUEST, content="Invalid Credentials")
 
-    return JSONResponse(status_code=status.HTTP_202_ACCEPTED, content="Logged In")
+class APIError(Exception):
+    def __init__(self, status_code: int, code: str, message: str):
+        self.status_code = status_code
+        self.code = code
+        self.message = message
 
 
-@app.post("/email")
-async def sending_message(
-    user: str = Form(...),
-    subject: str = Form(...),
-    body: str = Form(...),
-    email: UploadFile = Form(...),
-    db: Session = Depends(database.get_db)
+def error_response(status_code: int, code: str, message: str, details: Optional[list] = None,
+                   headers: Optional[dict] = None) -> ORJSONResponse:
+    error = schemas.ErrorResponse(error=schemas.ErrorDetail(code=code, message=message, details=details))
+    return ORJSONResponse(status_code=status_code, content=error.dict(exclude_none=True), headers=headers)
 
-) -> JSONResponse:
-    message_subject = subject
-    message_body = body
 
-    try:
-        dataframe = pd.read_csv(email.file, index_col=False, delimiter=',', header=None)
+def message_response(message: str, status_code: int = status.HTTP_200_OK,
+                     domains: Optional[dict] = None) -> ORJSONResponse:
+    response = schemas.MessageResponse(message=message, domains=domains)
+    return ORJSONResponse(status_code=status_code, content=response.dict(exclude_none=True))
 
-    except pandas.errors.EmptyDataError:
-        print("Provided csv file is empty")
-        return JSONResponse(status_code=status.HTTP_400_BAD_REQUEST,
-                            content={'message': 'Provided csv file is empty.'})
 
-    if not email.filename.endswith('.csv'):
-        print("Please provide a csv file only")
-        return JSONResponse(status_code=status.HTTP_400_BAD_REQUEST,
-                            content={'message': 'Please provide a csv file only.'})
+@app.exception_handler(APIError)
+async def api_error_handler(request, exc: APIError):
+    return error_response(exc.status_code, exc.code, exc.message)
 
-    message = MessageSchema(
-        recipients=[mails for mails in dataframe[0]],
-        subject=message_subject,
-        body=message_body,
-        subtype="text"
-    )
 
-    try:
-        fm = FastMail(conf)
-        await fm.send_message(message)
+@app.exception_handler(StarletteHTTPException)
+async def http_exception_handler(request, exc: StarletteHTTPException):
+    code = HTTPStatus(exc.status_code).phrase.lower().replace(" ", "_").replace("-", "_")
+    return error_response(exc.status_code, code, str(exc.detail), headers=getattr(exc, "headers", None))
 
-    except Exception as e:
-        return JSONResponse(status_code=status.HTTP_400_BAD_REQUEST, content=e)
 
-    else:
-        new_log = models.Logs(username=user, date_time=str(datetime.datetime.now()), action_performed="Sent an e-Mail")
-        db.add(new_log)
-        db.commit()
-        db.refresh(new_log)
-        return JSONResponse(status_code=status.HTTP_200_OK, content="Email sent successfully")
+@app.exception_handler(RequestValidationError)
+async def validation_error_handler(request, exc: RequestValidationError):
+    return error_response(status.HTTP_422_UNPROCESSABLE_ENTITY, "validation_error", "Invalid request",
+                          details=jsonable_encoder(exc.errors()))
 
 
-@app.post("/email/file_with_message")
-async def sending_message_and_file(
-        background_tasks: BackgroundTasks,
-        user: str = Form(...),
-        subject: str = Form(...),
-        body: str = Form(...),
-        email: UploadFile = File(...),
-        file: List[UploadFile] = Form(...),
-        db: Session = Depends(database.get_db)
-) -> JSONResponse:
+def log_action(db: Session, user: str, action: str):
+    new_log = models.Logs(username=user, date_time=str(datetime.datetime.now()), action_performed=action)
+    db.add(new_log)
+    db.commit()
+
+
+def strip_link(link: str) -> str:
+    return HTML_TAG.sub('', markdown.markdown(link))
+
+
+def read_recipients(email: UploadFile) -> List[str]:
+    if not email.filename.endswith('.csv'):
+        raise APIError(status.HTTP_400_BAD_REQUEST, "invalid_csv", 'Please provide a csv file only.')
 
     try:
         dataframe = pd.read_csv(email.file, index_col=False, delimiter=',', header=None)
 
     except pandas.errors.EmptyDataError:
-        print("Provided csv file is empty")
-        return JSONResponse(status_code=status.HTTP_400_BAD_REQUEST,
-                            content={'message': 'Provided csv file is empty.'})
+        raise APIError(status.HTTP_400_BAD_REQUEST, "empty_csv", 'Provided csv file is empty.')
 
-    if not email.filename.endswith('.csv'):
-        print("Please provide a csv file only")
-        return JSONResponse(status_code=status.HTTP_400_BAD_REQUEST,
-                            content={'message': 'Please provide a csv file only.'})
-
-    message = MessageSchema(
-        recipients=[mails for mails in dataframe[0]],
-        subject=subject,
-        body=body,
-        subtype="text",
-        attachments=file
-    )
+    recipients = [str(mails).strip() for mails in dataframe[0].dropna()]
+    invalid = [mails for mails in recipients if "@" not in mails]
+    if invalid:
+        raise APIError(status.HTTP_400_BAD_REQUEST, "invalid_recipient",
+                       'Invalid e-mail address in csv file: ' + ', '.join(invalid[:5]))
+
+    return recipients
 
+
+def schedule_time(date_and_time: str) -> datetime.datetime:
     try:
-        fm = FastMail(conf)
-        background_tasks.add_task(fm.send_message, message)
+        scheduled_at = datetime.datetime(year=int(date_and_time[:4]), month=int(date_and_time[5:7]),
+                                         day=int(date_and_time[8:10]), hour=int(date_and_time[11:13]),
+                                         minute=int(date_and_time[14:16]))
+    except ValueError:
+        raise APIError(status.HTTP_400_BAD_REQUEST, "invalid_date", 'date_and_time must look like YYYY-MM-DD HH:MM')
 
-    except Exception as e:
-        return JSONResponse(status_code=status.HTTP_400_BAD_REQUEST, content=e)
+    if datetime.datetime.now() > scheduled_at:
+        raise APIError(status.HTTP_400_BAD_REQUEST, "past_schedule", 'Past is out of your hands')
 
-    else:
-        new_log = models.Logs(username=user, date_time=str(datetime.datetime.now()), action_performed="Sent an e-Mail consisting of FIle")
-        db.add(new_log)
-        db.commit()
-        db.refresh(new_log)
-        return JSONResponse(status_code=200, content='Email consisting of File is sent successfully')
+    return scheduled_at
 
 
-@app.post("/email/link")
-async def sending_link_with_message(
-    user: str = Form(...),
-    subject: str = Form(...),
-    link: str = Form(...),
-    body: str = Form(...),
-    email: UploadFile = File(...),
-    db: Session = Depends(database.get_db)
+def schedule_fields(date_and_time: str) -> dict:
+    scheduled_at = schedule_time(date_and_time)
+    return dict(year=scheduled_at.year, month=scheduled_at.month, day=scheduled_at.day,
+                hour=scheduled_at.hour, minute=scheduled_at.minute)
 
-) -> JSONResponse:
-    message_subject = subject
-    link = markdown.markdown(link)
-    link = re.compile(r'<.*?>').sub('', link)
-    message_body = link + "\n" + body
 
-    try:
-        dataframe = pd.read_csv(email.file, index_col=False, delimiter=',', header=None)
+async def send_grouped_by_domain(delivery_mode: str, recipients: List[str], subject: str, body: str,
+                                 attachments: List[UploadFile] = None) -> dict:
+    files = [(attachment.filename, await attachment.read()) for attachment in attachments or []]
+    message = delivery.build_message(conf.MAIL_FROM, subject, body, files)
+    reports = await delivery.send_by_domain(message, recipients, delivery.router, mode=delivery_mode)
+    return {domain: dataclasses.asdict(report) for domain, report in reports.items()}
 
-    except pandas.errors.EmptyDataError:
-        print("Provided csv file is empty")
-        return JSONResponse(status_code=status.HTTP_400_BAD_REQUEST,
-                            content={'message': 'Provided csv file is empty.'})
 
-    if not email.filename.endswith('.csv'):
-        print("Please provide a csv file only")
-        return JSONResponse(status_code=status.HTTP_400_BAD_REQUEST,
-                            content={'message': 'Please provide a csv file only.'})
-
-    message = MessageSchema(
-        recipients=[mails for mails in dataframe[0]],
-        subject=message_subject,
-        body=message_body,
-        subtype="text"
-    )
-    try:
-        fm = FastMail(conf)
-        await fm.send_message(message)
+async def send_email(delivery_mode: str, recipients: List[str], subject: str, body: str,
+                     attachments: List[UploadFile] = None) -> Optional[dict]:
+    if delivery_mode != "single":
+        return await send_grouped_by_domain(delivery_mode, recipients, subject, body, attachments)
 
-    except Exception as e:
-        return JSONResponse(status_code=status.HTTP_400_BAD_REQUEST, content=e)
+    message = MessageSchema(recipients=recipients, subject=subject, body=body, subtype="text",
+                            attachments=attachments or [])
+    fm = FastMail(conf)
+    await fm.send_message(message)
 
-    else:
-        new_log = models.Logs(username=user, date_time=str(datetime.datetime.now()),
-                              action_performed="Sent an e-Mail consisting of FIle")
-        db.add(new_log)
-        db.commit()
-        db.refresh(new_log)
-        return JSONResponse(status_code=200, content="Email consisting of Link is sent successfully")
 
+def sent_response(db: Session, user: str, action: str, message: str,
+                        domains: Optional[dict]) -> ORJSONResponse:
+    """Log and acknowledge a send; grouped deliveries that missed recipients are reported as such."""
+    failed = 0
+    if domains is not None:
+        sent = sum(report["sent"] for report in domains.values())
+        failed = sum(len(report["failed"]) for report in domains.values())
+        if not sent:
+            return error_response(status.HTTP_502_BAD_GATEWAY, "delivery_failed", "No recipient could be reached.",
+                                  details=[dict(domain=domain, **report) for domain, report in domains.items()])
 
-@app.post("/email/schedulingMessage")
-async def scheduling(
-        user: str = Form(...),
-        subject: str = Form(...),
-        body: str = Form(...),
-        email: UploadFile = File(...),
-        date_and_time: str = Form(...),
-        db: Session = Depends(database.get_db)
-) -> JSONResponse:
+    log_action(db, user, action)
+    if failed:
+        return message_response(f"Email sent to {sent} of {sent + failed} recipients",
+                                status_code=status.HTTP_207_MULTI_STATUS, domains=domains)
+    return message_response(message, domains=domains)
 
-    year = date_and_time[:4]
-    month = date_and_time[5:7]
-    day = date_and_time[8:10]
-    hour = date_and_time[11:13]
-    minute = date_and_time[14:16]
 
-    if datetime.datetime.now() > datetime.datetime(year=int(year), month=int(month), day=int(day), hour=int(hour), minute=int(minute)):
-        return JSONResponse(status_code=status.HTTP_404_NOT_FOUND, content='Past is out of your hands')
+async def deduplicated_send(db: Session, key: str, channel: str, user: str, cost: float,
+                            do_send: Callable[[], Awaitable[Optional[dict]]], log_message: str, ok_message: str,
+                            errors: tuple = (Exception,), error_code: str = "send_failed") -> ORJSONResponse:
+    """Send once per dedup key, holding a ``channel`` admission slot only while actually sending.
 
-    try:
-        dataframe = pd.read_csv(email.file, index_col=False, delimiter=',', header=None)
+    ``do_send`` may return per-domain reports for grouped email deliveries.
+    """
+    async def send():
+        async with await admission.controller.acquire(channel, user, cost=cost):
+            try:
+                domains = await do_send()
 
-    except pandas.errors.EmptyDataError:
-        print("Provided csv file is empty")
-        return JSONResponse(status_code=status.HTTP_400_BAD_REQUEST,
-                            content={'message': 'Provided csv file is empty.'})
+            except errors as e:
+                return error_response(status.HTTP_400_BAD_REQUEST, error_code, str(e))
 
-    if not email.filename.endswith('.csv'):
-        print("Please provide a csv file only")
-        return JSONResponse(status_code=status.HTTP_400_BAD_REQUEST,
-                            content={'message': 'Please provide a csv file only.'})
-
-    async def scheduling_message_schema():
-        message = MessageSchema(
-            recipients=[mails for mails in dataframe[0]],
-            subject=subject,
-            body=body,
-            subtype="text"
-        )
+        return sent_response(db, user, log_message, ok_message, domains)
 
-        try:
-            fm = FastMail(conf)
-            return await fm.send_message(message)
+    return await dedup.cache.run(key, send)
+
+
+async def post_to_discord(channel: discord.TextChannel, text: str):
+    await channel.send(text)
+
+
+async def post_to_slack(slack_client: WebClient, channel_id: str, text: str):
+    result = slack_client.chat_postMessage(channel=channel_id, text=text)
+    logger.info(result)
+
+
+async def send_email_payload(payload: dict):
+    attachments = [UploadFile(filename=filename, file=io.BytesIO(base64.b64decode(content)))
+                   for filename, content in payload.get("attachments", [])]
+    domains = await send_email(payload.get("delivery_mode", "single"), payload["recipients"], payload["subject"],
+                               payload["body"], attachments)
+    failed = [recipient for report in (domains or {}).values() for recipient in report["failed"]]
+    if failed:
+        raise RuntimeError(f"Could not deliver to {', '.join(failed)}")
+
+
+async def send_discord_payload(payload: dict):
+    # Sends restored from the outbox at startup can run before the gateway connection is ready.
+    await client.wait_until_ready()
+    channel = client.get_channel(DISCORD_CHANNEL_ID)
+    await channel.send(payload["text"])
+
+
+@app.get("/admission/stats")
+async def admission_stats():
+    return admission.controller.occupancy()
+
+
+@app.get("/dedup/stats")
+async def dedup_stats():
+    return await dedup.cache.stats()
+
+
+@app.get("/lifecycle/stats")
+async def lifecycle_stats():
+    return lifecycle.manager.stats()
+
+
+@app.post("/login")
+async def user_login(form: schemas.LoginForm = Depends(schemas.LoginForm.as_form), db: Session = Depends(database.get_db)):
+    user = db.query(models.User).filter(models.User.username == form.username).first()
+    if not user:
+        return error_response(status.HTTP_404_NOT_FOUND, "user_not_found", f"user {form.username} does not exists.")
+
+    if form.password != user.password:
+        return error_response(status.HTTP_400_BAD_REQUEST, "invalid_credentials", "Invalid Credentials")
+
+    return message_response("Logged In", status_code=status.HTTP_202_ACCEPTED)
+
+
+@app.post("/email")
+async def sending_message(
+    form: schemas.EmailForm = Depends(schemas.EmailForm.as_form),
+    email: UploadFile = Form(...),
+    db: Session = Depends(database.get_db)
+
+) -> ORJSONResponse:
+    recipients = read_recipients(email)
 
-        except Exception as e:
-            return JSONResponse(status_code=status.HTTP_400_BAD_REQUEST, content=e)
+    return await deduplicated_send(
+        db, dedup.request_key(form.user, "email", recipients, form.subject, form.body), "email", form.user,
+        len(recipients), lambda: send_email(form.delivery_mode, recipients, form.subject, form.body),
+        "Sent an e-Mail", "Email sent successfully")
+
+
+@app.post("/email/json")
+async def sending_message_json(request: schemas.EmailRequest, db: Session = Depends(database.get_db)) -> ORJSONResponse:
+    body = request.body if request.link is None else strip_link(request.link) + "\n" + request.body
+
+    return await deduplicated_send(
+        db, dedup.request_key(request.user, "email", request.recipients, request.subject, body), "email",
+        request.user, len(request.recipients),
+        lambda: send_email(request.delivery_mode, request.recipients, request.subject, body),
+        "Sent an e-Mail", "Email sent successfully")
+
+
+@app.post("/email/file_with_message")
+async def sending_message_and_file(
+        form: schemas.EmailForm = Depends(schemas.EmailForm.as_form),
+        email: UploadFile = File(...),
+        file: List[UploadFile] = Form(...),
+        db: Session = Depends(database.get_db),
+        lease: admission.Lease = Depends(admission.admit("email", charge=False))
+) -> ORJSONResponse:
+
+    recipients = read_recipients(email)
+    lease.charge(len(recipients))
 
     try:
-        scheduler = AsyncIOScheduler()
-        scheduler.add_job(scheduling_message_schema, 'cron', year=year, month=month, day=day, hour=hour, minute=minute,
-                          second='00', timezone="Asia/Kolkata")
-        scheduler.start()
-        print(scheduler.get_jobs())
+        # The payload holds the file contents so the send can be persisted if the worker shuts down mid-send.
+        attachments = [(attachment.filename, base64.b64encode(await attachment.read()).decode()) for attachment in file]
+        lifecycle.manager.submit("email", {
+            "delivery_mode": form.delivery_mode,
+            "recipients": recipients,
+            "subject": form.subject,
+            "body": form.body,
+            "attachments": attachments,
+        }, lease=lease)
 
     except Exception as e:
-        return JSONResponse(status_code=status.HTTP_400_BAD_REQUEST, content=e)
+        return error_response(status.HTTP_400_BAD_REQUEST, "send_failed", str(e))
 
     else:
-        new_log = models.Logs(username=user, date_time=str(datetime.datetime.now()),
-                              action_performed="Scheduled an e-Mail")
-        db.add(new_log)
-        db.commit()
-        db.refresh(new_log)
-        return JSONResponse(status_code=status.HTTP_200_OK, content="Scheduled Email successfully")
+        log_action(db, form.user, "Sent an e-Mail consisting of FIle")
+        return message_response('Email consisting of File is sent successfully')
 
 
-@app.post("/email/schedulingLink")
-async def scheduling_link(
-        user: str = Form(...),
-        subject: str = Form(...),
-        body: str = Form(...),
-        link: str = Form(...),
-        email: UploadFile = File(...),
-        date_and_time: str = Form(...),
-        db: Session = Depends(database.get_db)
+@app.post("/email/link")
+async def sending_link_with_message(
+    form: schemas.EmailLinkForm = Depends(schemas.EmailLinkForm.as_form),
+    email: UploadFile = File(...),
+    db: Session = Depends(database.get_db)
+
+) -> ORJSONResponse:
+    message_body = strip_link(form.link) + "\n" + form.body
 
-) -> JSONResponse:
-    year = date_and_time[:4]
-    month = date_and_time[5:7]
-    day = date_and_time[8:10]
-    hour = date_and_time[11:13]
-    minute = date_and_time[14:16]
+    recipients = read_recipients(email)
 
-    if datetime.datetime.now() > datetime.datetime(year=int(year), month=int(month), day=int(day), hour=int(hour), minute=int(minute)):
-        return JSONResponse(status_code=status.HTTP_404_NOT_FOUND, content='Past is out of your hands')
+    return await deduplicated_send(
+        db, dedup.request_key(form.user, "email", recipients, form.subject, message_body), "email", form.user,
+        len(recipients), lambda: send_email(form.delivery_mode, recipients, form.subject, message_body),
+        "Sent an e-Mail consisting of FIle", "Email consisting of Link is sent successfully")
 
-    link = markdown.markdown(link)
-    link = re.compile(r'<.*?>').sub('', link)
+
+@app.post("/email/schedulingMessage")
+async def scheduling(
+        form: schemas.ScheduledEmailForm = Depends(schemas.ScheduledEmailForm.as_form),
+        email: UploadFile = File(...),
+        db: Session = Depends(database.get_db),
+        lease: admission.Lease = Depends(admission.admit("email", charge=False))
+) -> ORJSONResponse:
+
+    fields = schedule_fields(form.date_and_time)
+    recipients = read_recipients(email)
+    lease.charge(len(recipients))
 
     try:
-        dataframe = pd.read_csv(email.file, index_col=False, delimiter=',', header=None)
+        lifecycle.manager.schedule("email", {"recipients": recipients, "subject": form.subject, "body": form.body},
+                                   'cron', **fields, second='00')
 
-    except pandas.errors.EmptyDataError:
-        print("Provided csv file is empty")
-        return JSONResponse(status_code=status.HTTP_400_BAD_REQUEST,
-                            content={'message': 'Provided csv file is empty.'})
+    except Exception as e:
+        return error_response(status.HTTP_400_BAD_REQUEST, "schedule_failed", str(e))
 
-    if not email.filename.endswith('.csv'):
-        print("Please provide a csv file only")
-        return JSONResponse(status_code=status.HTTP_400_BAD_REQUEST,
-                            content={'message': 'Please provide a csv file only.'})
-
-    async def scheduling_message_schema():
-        message = MessageSchema(
-            recipients=[mails for mails in dataframe[0]],
-            subject=subject,
-            body=link + "\n" + body,
-            subtype="text"
-        )
-        try:
-            fm = FastMail(conf)
-            return await fm.send_message(message)
+    else:
+        log_action(db, form.user, "Scheduled an e-Mail")
+        return message_response("Scheduled Email successfully")
 
-        except Exception as e:
-            return JSONResponse(status_code=status.HTTP_400_BAD_REQUEST, content=e)
+
+@app.post("/email/schedulingLink")
+async def scheduling_link(
+        form: schemas.ScheduledEmailLinkForm = Depends(schemas.ScheduledEmailLinkForm.as_form),
+        email: UploadFile = File(...),
+        db: Session = Depends(database.get_db),
+        lease: admission.Lease = Depends(admission.admit("email", charge=False))
+
+) -> ORJSONResponse:
+    fields = schedule_fields(form.date_and_time)
+    link = strip_link(form.link)
+
+    recipients = read_recipients(email)
+    lease.charge(len(recipients))
 
     try:
-        scheduler = AsyncIOScheduler()
-        scheduler.add_job(scheduling_message_schema, 'cron', year=year, month=month, day=day, hour=hour, minute=minute,
-                          second='00', timezone="Asia/Kolkata")
-        scheduler.start()
-        print(scheduler.get_jobs())
+        lifecycle.manager.schedule("email", {"recipients": recipients, "subject": form.subject,
+                                             "body": link + "\n" + form.body},
+                                   'cron', **fields, second='00')
 
     except Exception as e:
-        return JSONResponse(status_code=status.HTTP_400_BAD_REQUEST, content=e)
+        return error_response(status.HTTP_400_BAD_REQUEST, "schedule_failed", str(e))
 
     else:
-        new_log = models.Logs(username=user, date_time=str(datetime.datetime.now()),
-                              action_performed="Scheduled an e-Mail consisting of link")
-        db.add(new_log)
-        db.commit()
-        db.refresh(new_log)
-        return JSONResponse(status_code=status.HTTP_200_OK, content="Email scheduled successfully")
+        log_action(db, form.user, "Scheduled an e-Mail consisting of link")
+        return message_response("Email scheduled successfully")
 
 client = discord.Client()
 
@@ -363,31 +403,39 @@ client = discord.Client()
 @app.on_event("startup")
 async def startup_event():
     asyncio.create_task(client.start(os.getenv('DISCORD_BOT_TOKEN')))
+    lifecycle.manager.register("email", send_email_payload)
+    lifecycle.manager.register("discord", send_discord_payload)
+    lifecycle.manager.on_shutdown(client.close)
+    await lifecycle.manager.startup()
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await lifecycle.manager.shutdown()
 
 
 @app.post("/discord/message")
-async def sending_message(user: str = Form(...), message: str = Form(...), db: Session = Depends(database.get_db)):
-    channel_id = 955391175823618072
-    channel = client.get_channel(channel_id)
-    try:
-        await channel.send(message)
+async def sending_message(form: schemas.MessageForm = Depends(schemas.MessageForm.as_form), db: Session = Depends(database.get_db)):
+    channel = client.get_channel(DISCORD_CHANNEL_ID)
 
-    except Exception as e:
-        return JSONResponse(status_code=status.HTTP_400_BAD_REQUEST, content=e)
+    return await deduplicated_send(
+        db, dedup.request_key(form.user, f"discord:{DISCORD_CHANNEL_ID}", [], form.message), "discord", form.user, 1,
+        lambda: post_to_discord(channel, form.message), "Sent the Discord Message", 'Message sent Successfully')
 
-    else:
-        new_log = models.Logs(username=user, date_time=str(datetime.datetime.now()),
-                              action_performed="Sent the Discord Message")
-        db.add(new_log)
-        db.commit()
-        db.refresh(new_log)
-        return JSONResponse(status_code=status.HTTP_200_OK, content='Message sent Successfully')
 
+@app.post("/discord/message/json")
+async def sending_message_json(request: schemas.ChatMessageRequest, db: Session = Depends(database.get_db)):
+    text = request.message if request.link is None else request.message + "\n" + strip_link(request.link)
+    channel = client.get_channel(DISCORD_CHANNEL_ID)
+
+    return await deduplicated_send(
+        db, dedup.request_key(request.user, f"discord:{DISCORD_CHANNEL_ID}", [], text), "discord", request.user, 1,
+        lambda: post_to_discord(channel, text), "Sent the Discord Message", 'Message sent Successfully')
 
-@app.post("/discord/file_with_message")
-async def sending_message_and_file(user: str = Form(...), message: str = Form(...), file: UploadFile = Form(...), db: Session = Depends(database.get_db)):
-    channel_id = 955391175823618072
-    channel = client.get_channel(channel_id)
+
+@app.post("/discord/file_with_message", dependencies=[Depends(admission.admit("discord"))])
+async def sending_message_and_file(form: schemas.MessageForm = Depends(schemas.MessageForm.as_form), file: UploadFile = Form(...), db: Session = Depends(database.get_db)):
+    channel = client.get_channel(DISCORD_CHANNEL_ID)
 
     try:
         try:
@@ -398,161 +446,92 @@ async def sending_message_and_file(user: str = Form(...), message: str = Form(..
         finally:
             file.file.close()
 
-        await channel.send(content=message, tts=False, embed=None,
+        await channel.send(content=form.message, tts=False, embed=None,
                            file=discord.File(tmp_path, spoiler=True), files=None, delete_after=None, nonce=None,
                            allowed_mentions=None, reference=None, mention_author=None)
 
     except Exception as e:
-        return JSONResponse(status_code=status.HTTP_400_BAD_REQUEST, content=e)
+        return error_response(status.HTTP_400_BAD_REQUEST, "send_failed", str(e))
 
     else:
-        new_log = models.Logs(username=user, date_time=str(datetime.datetime.now()),
-                              action_performed="Sent a discord message with file")
-        db.add(new_log)
-        db.commit()
-        db.refresh(new_log)
-        return JSONResponse(status_code=status.HTTP_200_OK, content='File and Message sent Successfully.')
+        log_action(db, form.user, "Sent a discord message with file")
+        return message_response('File and Message sent Successfully.')
 
     finally:
         os.remove(tmp_path)
 
 
 @app.post("/discord/link_with_message")
-async def sending_message_and_link(user: str = Form(...), message: str = Form(...), link: str = Form(...), db: Session = Depends(database.get_db)):
-    channel_id = 955391175823618072
-    channel = client.get_channel(channel_id)
-
-    link = markdown.markdown(link)
-    link = re.compile(r'<.*?>').sub('', link)
-    try:
-        await channel.send(message + "\n" + link)
+async def sending_message_and_link(form: schemas.LinkMessageForm = Depends(schemas.LinkMessageForm.as_form), db: Session = Depends(database.get_db)):
+    channel = client.get_channel(DISCORD_CHANNEL_ID)
 
-    except Exception as e:
-        new_log = models.Logs(username=user, date_time=str(datetime.datetime.now()),
-                              action_performed="Sent a discord message with a link")
-        db.add(new_log)
-        db.commit()
-        db.refresh(new_log)
-        return JSONResponse(status_code=status.HTTP_400_BAD_REQUEST, content=e)
+    text = form.message + "\n" + strip_link(form.link)
 
-    else:
-        return JSONResponse(status_code=status.HTTP_200_OK, content='Message sent Successfully.')
+    return await deduplicated_send(
+        db, dedup.request_key(form.user, f"discord:{DISCORD_CHANNEL_ID}", [], text), "discord", form.user, 1,
+        lambda: post_to_discord(channel, text), "Sent a discord message with a link", 'Message sent Successfully.')
 
 
-@app.post("/discord/schedule_message")
-async def scheduling_message(user: str = Form(...), message: str = Form(...), date_and_time: str = Form(...), db: Session = Depends(database.get_db)):
-    year = date_and_time[:4]
-    month = date_and_time[5:7]
-    day = date_and_time[8:10]
-    hour = date_and_time[11:13]
-    minute = date_and_time[14:16]
-
-    if datetime.datetime.now() > datetime.datetime(year=int(year), month=int(month), day=int(day), hour=int(hour), minute=int(minute)):
-        return JSONResponse(status_code=status.HTTP_400_BAD_REQUEST, content='Past is out of your hands')
-
-    async def scheduling_message_send():
-        channel_id = 955391175823618072
-        channel = client.get_channel(channel_id)
-        try:
-            return await channel.send(message)
-
-        except Exception as e:
-            return JSONResponse(status_code=status.HTTP_400_BAD_REQUEST, content=e)
+@app.post("/discord/schedule_message", dependencies=[Depends(admission.admit("discord"))])
+async def scheduling_message(form: schemas.ScheduledMessageForm = Depends(schemas.ScheduledMessageForm.as_form), db: Session = Depends(database.get_db)):
+    fields = schedule_fields(form.date_and_time)
 
     try:
-        scheduler = AsyncIOScheduler()
-        scheduler.add_job(scheduling_message_send, 'cron', year=year, month=month, day=day, hour=hour, minute=minute,
-                          second='00', timezone="Asia/Kolkata")
-
-        scheduler.start()
-        print(scheduler.get_jobs())
+        lifecycle.manager.schedule("discord", {"text": form.message}, 'cron', **fields, second='00')
 
     except Exception as e:
-        return JSONResponse(status_code=status.HTTP_400_BAD_REQUEST, content=e)
+        return error_response(status.HTTP_400_BAD_REQUEST, "schedule_failed", str(e))
 
     else:
-        new_log = models.Logs(username=user, date_time=str(datetime.datetime.now()),
-                              action_performed="Sent a discord message with a link")
-        db.add(new_log)
-        db.commit()
-        db.refresh(new_log)
-        return JSONResponse(status_code=status.HTTP_200_OK, content='Message Scheduled Successfully')
-
-
-@app.post("/discord/schedule_link_with_message")
-async def scheduling_message_and_link(user: str = Form(...), message: str = Form(...), date_and_time: str = Form(...), link: str = Form(...), db: Session = Depends(database.get_db)):
-    link = markdown.markdown(link)
-    link = re.compile(r'<.*?>').sub('', link)
-
-    year = date_and_time[:4]
-    month = date_and_time[5:7]
-    day = date_and_time[8:10]
-    hour = date_and_time[11:13]
-    minute = date_and_time[14:16]
-
-    if datetime.datetime.now() > datetime.datetime(year=int(year), month=int(month), day=int(day), hour=int(hour), minute=int(minute)):
-        return JSONResponse(status_code=status.HTTP_400_BAD_REQUEST, content='Past is out of your hands')
-
-    async def scheduling_message_send():
-        channel_id = 955391175823618072
-        channel = client.get_channel(channel_id)
-        try:
-            return await channel.send(message + "\n" + link)
+        log_action(db, form.user, "Sent a discord message with a link")
+        return message_response('Message Scheduled Successfully')
 
-        except Exception as e:
-            return JSONResponse(status_code=status.HTTP_400_BAD_REQUEST, content=e)
 
-    try:
-        scheduler = AsyncIOScheduler()
-        scheduler.add_job(scheduling_message_send, 'cron', year=year, month=month, day=day, hour=hour, minute=minute,
-                          second='00', timezone="Asia/Kolkata")
+@app.post("/discord/schedule_link_with_message", dependencies=[Depends(admission.admit("discord"))])
+async def scheduling_message_and_link(form: schemas.ScheduledLinkMessageForm = Depends(schemas.ScheduledLinkMessageForm.as_form), db: Session = Depends(database.get_db)):
+    link = strip_link(form.link)
+    fields = schedule_fields(form.date_and_time)
 
-        scheduler.start()
-        print(scheduler.get_jobs())
+    try:
+        lifecycle.manager.schedule("discord", {"text": form.message + "\n" + link}, 'cron', **fields, second='00')
 
     except Exception as e:
-        return JSONResponse(status_code=status.HTTP_400_BAD_REQUEST, content=e)
+        return error_response(status.HTTP_400_BAD_REQUEST, "schedule_failed", str(e))
 
     else:
-        new_log = models.Logs(username=user, date_time=str(datetime.datetime.now()),
-                              action_performed="Scheduled a Discord Message with a Link")
-        db.add(new_log)
-        db.commit()
-        db.refresh(new_log)
-        return JSONResponse(status_code=status.HTTP_200_OK, content='Message Scheduled Successfully')
+        log_action(db, form.user, "Scheduled a Discord Message with a Link")
+        return message_response('Message Scheduled Successfully')
 
 
 @app.post("/slack/message")
-async def sending_message(user: str = Form(...), message: str = Form(...), db: Session = Depends(database.get_db)):
+async def sending_message(form: schemas.MessageForm = Depends(schemas.MessageForm.as_form), db: Session = Depends(database.get_db)):
     slack_client = WebClient(token=os.getenv("SLACK_BOT_TOKEN"))
-    logger = logging.getLogger(__name__)
 
     channel_id = "C03826TDBTL"
 
-    try:
-        result = slack_client.chat_postMessage(
-            channel=channel_id,
-            text=message
-        )
+    return await deduplicated_send(
+        db, dedup.request_key(form.user, f"slack:{channel_id}", [], form.message), "slack", form.user, 1,
+        lambda: post_to_slack(slack_client, channel_id, form.message), "Send a Slack Message",
+        'Message Sent Successfully', errors=(SlackApiError,), error_code="slack_api_error")
 
-        logger.info(result)
 
-    except SlackApiError as e:
-        return JSONResponse(status_code=status.HTTP_400_BAD_REQUEST, content=e)
+@app.post("/slack/message/json")
+async def sending_message_json(request: schemas.ChatMessageRequest, db: Session = Depends(database.get_db)):
+    slack_client = WebClient(token=os.getenv("SLACK_BOT_TOKEN"))
+    text = request.message if request.link is None else request.message + "\n" + strip_link(request.link)
 
-    else:
-        new_log = models.Logs(username=user, date_time=str(datetime.datetime.now()),
-                              action_performed="Send a Slack Message")
-        db.add(new_log)
-        db.commit()
-        db.refresh(new_log)
-        return JSONResponse(status_code=status.HTTP_200_OK, content='Message Sent Successfully')
+    # Same channels as the multipart /slack/message and /slack/link_with_message routes.
+    channel_id = "C03826TDBTL" if request.link is None else "C039T5WBGG0"
+
+    return await deduplicated_send(
+        db, dedup.request_key(request.user, f"slack:{channel_id}", [], text), "slack", request.user, 1,
+        lambda: post_to_slack(slack_client, channel_id, text), "Send a Slack Message",
+        'Message Sent Successfully', errors=(SlackApiError,), error_code="slack_api_error")
 
 
-@app.post("/slack/file_with_message")
-async def sending_message_and_file(user: str = Form(...) ,message: str = Form(...), file: UploadFile = Form(...), db: Session = Depends(database.get_db)):
+@app.post("/slack/file_with_message", dependencies=[Depends(admission.admit("slack"))])
+async def sending_message_and_file(form: schemas.MessageForm = Depends(schemas.MessageForm.as_form), file: UploadFile = Form(...), db: Session = Depends(database.get_db)):
     slack_client = WebClient(token=os.getenv("SLACK_BOT_TOKEN"))
-    logger = logging.getLogger(__name__)
 
     try:
         suffix = Path(file.filename).suffix
@@ -568,134 +547,83 @@ async def sending_message_and_file(user: str = Form(...) ,message: str = Form(..
     try:
         result = slack_client.files_upload(
             channels=channel_id,
-            initial_comment=message,
+            initial_comment=form.message,
             file=tmp_path
         )
 
         logger.info(result)
 
     except SlackApiError as e:
-        return JSONResponse(status_code=status.HTTP_400_BAD_REQUEST, content=e)
+        return error_response(status.HTTP_400_BAD_REQUEST, "slack_api_error", str(e))
 
     else:
-        new_log = models.Logs(username=user, date_time=str(datetime.datetime.now()),
-                              action_performed="Send a Slack Message with a File")
-        db.add(new_log)
-        db.commit()
-        db.refresh(new_log)
-        return JSONResponse(status_code=status.HTTP_200_OK, content='Message Sent Successfully')
+        log_action(db, form.user, "Send a Slack Message with a File")
+        return message_response('Message Sent Successfully')
 
     finally:
         os.remove(tmp_path)
 
 
 @app.post("/slack/link_with_message")
-async def sending_message_and_link(user: str = Form(...), message: str = Form(...), link: str = Form(...), db: Session = Depends(database.get_db)):
+async def sending_message_and_link(form: schemas.LinkMessageForm = Depends(schemas.LinkMessageForm.as_form), db: Session = Depends(database.get_db)):
     slack_client = WebClient(token=os.getenv("SLACK_BOT_TOKEN"))
-    logger = logging.getLogger(__name__)
 
     channel_id = "C039T5WBGG0"
 
-    link = markdown.markdown(link)
-    link = re.compile(r'<.*?>').sub('', link)
+    text = form.message + "\n" + strip_link(form.link)
 
-    try:
-        result = slack_client.chat_postMessage(
-            channel=channel_id,
-            text=message + "\n" + link
-        )
+    return await deduplicated_send(
+        db, dedup.request_key(form.user, f"slack:{channel_id}", [], text), "slack", form.user, 1,
+        lambda: post_to_slack(slack_client, channel_id, text), "Send a Slack Message with a Link",
+        'Message sent Successfully', errors=(SlackApiError,), error_code="slack_api_error")
 
-        logger.info(result)
 
-    except SlackApiError as e:
-        return JSONResponse(status_code=status.HTTP_400_BAD_REQUEST, content=e)
-
-    else:
-        new_log = models.Logs(username=user, date_time=str(datetime.datetime.now()),
-                              action_performed="Send a Slack Message with a Link")
-        db.add(new_log)
-        db.commit()
-        db.refresh(new_log)
-        return JSONResponse(status_code=status.HTTP_200_OK, content='Message sent Successfully')
-
-
-@app.post("/slack/schedule_message")
-async def scheduling_message(user: str = Form(...), message: str = Form(...), date_and_time: str = Form(...), db: Session = Depends(database.get_db)):
+@app.post("/slack/schedule_message", dependencies=[Depends(admission.admit("slack"))])
+async def scheduling_message(form: schemas.ScheduledMessageForm = Depends(schemas.ScheduledMessageForm.as_form), db: Session = Depends(database.get_db)):
     slack_client = WebClient(token=os.getenv("SLACK_BOT_TOKEN"))
-    logger = logging.getLogger(__name__)
-
-    year = date_and_time[:4]
-    month = date_and_time[5:7]
-    day = date_and_time[8:10]
-    hour = date_and_time[11:13]
-    minute = date_and_time[14:16]
 
-    date_and_time = datetime.datetime.strptime(date_and_time, '%Y-%m-%d %H:%M')
+    date_and_time = schedule_time(form.date_and_time)
 
     channel_id = "C038RVCR19N"
 
-    if datetime.datetime.now() > datetime.datetime(year=int(year), month=int(month), day=int(day), hour=int(hour), minute=int(minute)):
-        return JSONResponse(status_code=status.HTTP_400_BAD_REQUEST, content='Past is out of your hands')
-
-
     try:
         result = slack_client.chat_scheduleMessage(
             channel=channel_id,
-            text=message,
+            text=form.message,
             post_at=int(date_and_time.timestamp())
         )
 
         logger.info(result)
 
     except SlackApiError as e:
-        return JSONResponse(status_code=status.HTTP_400_BAD_REQUEST, content=e)
+        return error_response(status.HTTP_400_BAD_REQUEST, "slack_api_error", str(e))
 
     else:
-        new_log = models.Logs(username=user, date_time=str(datetime.datetime.now()),
-                              action_performed="Schedule a Slack Message")
-        db.add(new_log)
-        db.commit()
-        db.refresh(new_log)
-        return JSONResponse(status_code=status.HTTP_200_OK, content='Message scheduled Successfully')
+        log_action(db, form.user, "Schedule a Slack Message")
+        return message_response('Message scheduled Successfully')
 
 
-@app.post("/slack/schedule_link_with_message")
-async def scheduling_message_and_link(user: str = Form(...), message: str = Form(...), link: str = Form(...), date_and_time: str = Form(...), db: Session = Depends(database.get_db)):
+@app.post("/slack/schedule_link_with_message", dependencies=[Depends(admission.admit("slack"))])
+async def scheduling_message_and_link(form: schemas.ScheduledLinkMessageForm = Depends(schemas.ScheduledLinkMessageForm.as_form), db: Session = Depends(database.get_db)):
     slack_client = WebClient(token=os.getenv("SLACK_BOT_TOKEN"))
-    logger = logging.getLogger(__name__)
 
-    year = date_and_time[:4]
-    month = date_and_time[5:7]
-    day = date_and_time[8:10]
-    hour = date_and_time[11:13]
-    minute = date_and_time[14:16]
-
-    date_and_time = datetime.datetime.strptime(date_and_time, '%Y-%m-%d %H:%M')
-    print(type(date_and_time))
+    date_and_time = schedule_time(form.date_and_time)
 
     channel_id = "C0390GC1F6Z"
 
-    if datetime.datetime.now() > datetime.datetime(year=int(year), month=int(month), day=int(day), hour=int(hour), minute=int(minute)):
-        return JSONResponse(status_code=status.HTTP_400_BAD_REQUEST, content='Past is out of your hands')
-
-    link = markdown.markdown(link)
-    link = re.compile(r'<.*?>').sub('', link)
+    link = strip_link(form.link)
     try:
         result = slack_client.chat_scheduleMessage(
             channel=channel_id,
-            text=message + '\n' + link,
+            text=form.message + '\n' + link,
             post_at=int(date_and_time.timestamp())
         )
         # Log the result
         logger.info(result)
 
     except SlackApiError as e:
-        return JSONResponse(status_code=status.HTTP_400_BAD_REQUEST, content=e)
+        return error_response(status.HTTP_400_BAD_REQUEST, "slack_api_error", str(e))
 
     else:
-        new_log = models.Logs(username=user, date_time=str(datetime.datetime.now()),
-                              action_performed="Scheduled a Slack Message with a Link")
-        db.add(new_log)
-        db.commit()
-        db.refresh(new_log)
-        return JSONResponse(status_code=status.HTTP_200_OK, content='Message scheduled Successfully')
+        log_action(db, form.user, "Scheduled a Slack Message with a Link")
+        return message_response('Message scheduled Successfully')
@@ -1,6 +1,6 @@
 import datetime
 
-from sqlalchemy import Column, Integer, String, ForeignKey
+from sqlalchemy import Column, Integer, Float, String, ForeignKey
 from sqlalchemy.orm import relationship
 
 from database import Base
@@ -27,3 +27,14 @@ class Logs(Base):
     action_performed = Column(String)
 
     editor = relationship("User", back_populates="logs")
+
+
+class Outbox(Base):
+    __tablename__ = 'outbox'
+
+    id = Column(Integer, primary_key=True, index=True)
+    kind = Column(String)
+    payload = Column(String)
+    run_at = Column(String, nullable=True)
+    claimed_by = Column(String, nullable=True)
+    claimed_until = Column(Float, nullable=True)
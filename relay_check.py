@@ -0,0 +1,85 @@
+"""Check per-domain delivery against local stand-in relays.
+
+Starts an aiosmtpd relay on localhost and routes domains to it the same way
+MAIL_RELAYS does, with one domain pointed at a closed port. Verifies the
+grouping into batches, the per-relay session cap, the per-domain reports and
+the headers of the message the relay receives. Requires ``pip install aiosmtpd``.
+
+    python relay_check.py
+"""
+import socket
+import asyncio
+import email
+
+from aiosmtpd.controller import Controller
+
+import delivery
+
+
+class RecordingHandler:
+    def __init__(self):
+        self.envelopes = []
+        self.active = 0
+        self.max_active = 0
+
+    async def handle_DATA(self, server, session, envelope):
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        await asyncio.sleep(0.1)
+        self.active -= 1
+        self.envelopes.append(envelope)
+        return "250 OK"
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def main():
+    handler = RecordingHandler()
+    relay_port, closed_port = free_port(), free_port()
+    controller = Controller(handler, hostname="127.0.0.1", port=relay_port)
+    controller.start()
+    try:
+        overrides = delivery.parse_relays(
+            f"good.com=127.0.0.1:{relay_port};other.com=127.0.0.1:{relay_port};bad.com=127.0.0.1:{closed_port}"
+        )
+        # Same relay as good.com, so its sessions count against the same cap; the relay
+        # does not advertise STARTTLS, so the opportunistic upgrade must be skipped.
+        overrides["plain.com"] = delivery.Relay(host="127.0.0.1", port=relay_port, opportunistic_tls=True)
+        for relay in overrides.values():
+            relay.max_sessions = 2
+        router = delivery.RelayRouter(overrides=overrides)
+        delivery.DOMAIN_PROFILES["good.com"] = delivery.DeliveryProfile(concurrency=2, batch_size=2)
+
+        message = delivery.build_message("sender@example.com", "Subject", "Body", [("notes.txt", b"hello")])
+        recipients = ["a@good.com", "b@good.com", "c@good.com", "d@other.com", "e@bad.com", "f@foo..com",
+                      "g@plain.com"]
+        reports = await delivery.send_by_domain(message, recipients, router, mode="mx")
+    finally:
+        controller.stop()
+
+    assert set(reports) == {"good.com", "other.com", "bad.com", "foo..com", "plain.com"}, reports
+    assert reports["good.com"].sent == 3 and not reports["good.com"].failed, reports["good.com"]
+    assert reports["other.com"].sent == 1, reports["other.com"]
+    assert reports["bad.com"].failed == ["e@bad.com"] and reports["bad.com"].errors, reports["bad.com"]
+    assert reports["foo..com"].failed == ["f@foo..com"], reports["foo..com"]
+    assert reports["plain.com"].sent == 1, reports["plain.com"]
+    assert handler.max_active <= 2, f"{handler.max_active} concurrent sessions on one relay"
+
+    batches = sorted(sorted(envelope.rcpt_tos) for envelope in handler.envelopes)
+    assert batches == [["a@good.com", "b@good.com"], ["c@good.com"], ["d@other.com"], ["g@plain.com"]], batches
+
+    received = email.message_from_bytes(handler.envelopes[0].content)
+    for header in ("From", "To", "Date", "Message-ID", "Subject"):
+        assert received[header], f"missing {header} header"
+
+    for domain, report in reports.items():
+        print(f"{domain:<10} {report}")
+    print("ok")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,7 +1,32 @@
 import datetime
-from typing import List
+import inspect
+from typing import Any, Dict, List, Literal, Optional
 
-from pydantic import BaseModel
+from fastapi import Form
+from pydantic import BaseModel, EmailStr
+
+
+DeliveryMode = Literal["single", "domain", "mx"]
+
+
+def as_form(cls):
+    """Add an ``as_form`` dependency that reads the model's fields from multipart form data."""
+    parameters = [
+        inspect.Parameter(
+            field.alias,
+            inspect.Parameter.KEYWORD_ONLY,
+            default=Form(...) if field.required else Form(field.default),
+            annotation=field.outer_type_,
+        )
+        for field in cls.__fields__.values()
+    ]
+
+    async def dependency(**data):
+        return cls(**data)
+
+    dependency.__signature__ = inspect.signature(dependency).replace(parameters=parameters)
+    cls.as_form = dependency
+    return cls
 
 
 class Log(BaseModel):
@@ -16,3 +41,92 @@ class User(BaseModel):
     email: str
     password: str
 
+
+@as_form
+class LoginForm(BaseModel):
+    username: str
+    password: str
+
+
+@as_form
+class MessageForm(BaseModel):
+    user: str
+    message: str
+
+
+@as_form
+class LinkMessageForm(MessageForm):
+    link: str
+
+
+@as_form
+class ScheduledMessageForm(MessageForm):
+    date_and_time: str
+
+
+@as_form
+class ScheduledLinkMessageForm(LinkMessageForm):
+    date_and_time: str
+
+
+@as_form
+class EmailForm(BaseModel):
+    user: str
+    subject: str
+    body: str
+    delivery_mode: DeliveryMode = "single"
+
+
+@as_form
+class EmailLinkForm(EmailForm):
+    link: str
+
+
+@as_form
+class ScheduledEmailForm(BaseModel):
+    user: str
+    subject: str
+    body: str
+    date_and_time: str
+
+
+@as_form
+class ScheduledEmailLinkForm(ScheduledEmailForm):
+    link: str
+
+
+class EmailRequest(BaseModel):
+    user: str
+    subject: str
+    body: str
+    recipients: List[EmailStr]
+    link: Optional[str] = None
+    delivery_mode: DeliveryMode = "single"
+
+
+class ChatMessageRequest(BaseModel):
+    user: str
+    message: str
+    link: Optional[str] = None
+
+
+class DomainDeliveryReport(BaseModel):
+    relay: Optional[str] = None
+    sent: int = 0
+    failed: List[str] = []
+    errors: List[str] = []
+
+
+class MessageResponse(BaseModel):
+    message: str
+    domains: Optional[Dict[str, DomainDeliveryReport]] = None
+
+
+class ErrorDetail(BaseModel):
+    code: str
+    message: str
+    details: Optional[List[Dict[str, Any]]] = None
+
+
+class ErrorResponse(BaseModel):
+    error: ErrorDetail